@@ -4,12 +4,21 @@ Generate the following packages:
 - Chip resistors SMT
 
 """
-from os import makedirs, path
-from uuid import uuid4
-
-from typing import Any, Dict, Iterable, Optional, Tuple
-
-from common import format_float as ff
+import io
+import sys
+from bisect import bisect_right
+from functools import lru_cache
+from os import O_CREAT, O_TRUNC, O_WRONLY
+from os import close as os_close
+from os import makedirs
+from os import open as os_open
+from os import path, urandom
+from os import write as os_write
+from string import Formatter
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from common import format_float
 from common import format_ipc_dimension as fd
 from common import generate_courtyard, indent, init_cache, now, save_cache
 
@@ -24,6 +33,54 @@ label_offset_thin = 0.8
 silkscreen_clearance = 0.15
 handsoldering_toe_extension = 0.5
 
+# Footprint variants in output order: Density level -> (UUID key, name)
+FOOTPRINT_VARIANTS = {
+    'B': ('density~b', 'Density Level B (median protrusion)'),
+    'A': ('density~a', 'Density Level A (max protrusion)'),
+    'C': ('density~c', 'Density Level C (min protrusion)'),
+}
+
+# UUID identifiers of the elements of each footprint variant
+FOOTPRINT_UUIDS = [
+    'footprint',
+    'text-name',
+    'text-value',
+    'line-silkscreen-top',
+    'line-silkscreen-bot',
+    'polygon-courtyard',
+    'polygon-outline-top',
+    'polygon-outline-bot',
+    'polygon-outline-left',
+    'polygon-outline-right',
+    'polygon-outline-around',
+    'polygon-polarization-mark',
+]
+
+# Placeholders to render footprints as templates, the UUIDs are substituted
+# with %-formatting. The rendered geometry itself never contains a '%'.
+FOOTPRINT_UUID_PLACEHOLDERS = {
+    identifier: '%({})s'.format(identifier)
+    for identifier in FOOTPRINT_UUIDS + ['pad-1', 'pad-2']
+}
+
+# Silkscreen and documentation line width by minimum body length
+LINE_WIDTHS = [
+    (0.0, line_width_thin, line_width_thinner),
+    (1.0, line_width_thin, line_width_thin),
+    (2.0, line_width, line_width),
+]
+LINE_WIDTHS_KEYS = [rule[0] for rule in LINE_WIDTHS]
+
+# Label offset by minimum body width
+LABEL_OFFSETS = [
+    (0.0, label_offset_thin),
+    (2.0, label_offset),
+]
+LABEL_OFFSETS_KEYS = [rule[0] for rule in LABEL_OFFSETS]
+
+# Memoized float formatting, many dimensions repeat across variants and configs
+ff = lru_cache(maxsize=None)(format_float)
+
 
 # Based on IPC 7351B (Table 3-5)
 DENSITY_LEVELS = {  # For 1608 and up
@@ -49,9 +106,159 @@ def get_by_density(length: float, level: str, key: str) -> float:
     return table[level][key]
 
 
+# Output templates, one per logical block of the package file, each ending
+# with a newline. They are filled in using %-formatting with a mapping, so
+# that each block is built with a single formatting operation instead of one
+# per line. Parts that only depend on module constants are substituted at
+# import time.
+TEXT_ATTRS = '(height {}) (stroke_width 0.2) ' \
+             '(letter_spacing auto) (line_spacing auto)'.format(pkg_text_height)
+
+PKG_HEADER_TMPL = """(librepcb_package %(uuid)s
+ (name "%(name)s")
+ (description "%(description)s\\n\\nGenerated with """ + generator + """")
+ (keywords "%(keywords)s")
+ (author "%(author)s")
+ (version "%(version)s")
+ (created %(created)s)
+ (deprecated false)
+ (category %(category)s)
+ (pad %(uuid_pad_1)s (name "%(name_pad_1)s"))
+ (pad %(uuid_pad_2)s (name "%(name_pad_2)s"))
+"""
+
+FOOTPRINT_HEADER_TMPL = """ (footprint %(uuid)s
+  (name "%(name)s")
+  (description "")
+"""
+
+PAD_TMPL = """  (pad %(uuid)s (side top) (shape rect)
+   (position %(x)s 0.0) (rotation 0.0) (size %(length)s %(width)s) (drill 0.0)
+  )
+"""
+
+# Rectangle with the corners (x1, y), (x2, y), (x2, -y), (x1, -y)
+RECT_POLYGON_TMPL = """  (polygon %(uuid)s (layer %(layer)s)
+   (width %(width)s) (fill %(fill)s) (grab_area %(grab_area)s)
+   (vertex (position %(x1)s %(y)s) (angle 0.0))
+   (vertex (position %(x2)s %(y)s) (angle 0.0))
+   (vertex (position %(x2)s -%(y)s) (angle 0.0))
+   (vertex (position %(x1)s -%(y)s) (angle 0.0))
+   (vertex (position %(x1)s %(y)s) (angle 0.0))
+  )
+"""
+
+# Like RECT_POLYGON_TMPL, but open on the (x1, -y) to (x1, y) side
+OPEN_RECT_POLYGON_TMPL = """  (polygon %(uuid)s (layer %(layer)s)
+   (width %(width)s) (fill false) (grab_area false)
+   (vertex (position %(x1)s %(y)s) (angle 0.0))
+   (vertex (position %(x2)s %(y)s) (angle 0.0))
+   (vertex (position %(x2)s -%(y)s) (angle 0.0))
+   (vertex (position %(x1)s -%(y)s) (angle 0.0))
+  )
+"""
+
+LINE_POLYGON_TMPL = """  (polygon %(uuid)s (layer %(layer)s)
+   (width %(width)s) (fill false) (grab_area false)
+   (vertex (position %(x1)s %(y)s) (angle 0.0))
+   (vertex (position %(x2)s %(y)s) (angle 0.0))
+  )
+"""
+
+LABELS_TMPL = """  (stroke_text %(uuid_name)s (layer top_names)
+   """ + TEXT_ATTRS + """
+   (align center bottom) (position 0.0 %(dy)s) (rotation 0.0)
+   (auto_rotate true) (mirror false) (value "{{NAME}}")
+  )
+  (stroke_text %(uuid_value)s (layer top_values)
+   """ + TEXT_ATTRS + """
+   (align center top) (position 0.0 -%(dy)s) (rotation 0.0)
+   (auto_rotate true) (mirror false) (value "{{VALUE}}")
+  )
+"""
+
+
+def random_uuid() -> str:
+    """
+    Return a new random (version 4) UUID in its canonical hyphenated form.
+
+    Equivalent to ``str(uuid.uuid4())``, but formats the random bytes
+    directly instead of going through the ``UUID`` object.
+    """
+    b = bytearray(urandom(16))
+    b[6] = (b[6] & 0x0f) | 0x40  # Version 4
+    b[8] = (b[8] & 0x3f) | 0x80  # RFC 4122 variant
+    h = b.hex()
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def write_file(filepath: str, content: str) -> bool:
+    """
+    Write the content to the file with a single unbuffered write.
+
+    If the file already exists with exactly this content, it is left
+    untouched. Returns whether the file was written.
+    """
+    data = content.encode('utf-8')
+    try:
+        if path.getsize(filepath) == len(data):
+            with open(filepath, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+    fileno = os_open(filepath, O_WRONLY | O_CREAT | O_TRUNC, 0o666)
+    try:
+        os_write(fileno, data)
+    finally:
+        os_close(fileno)
+    return True
+
+
+@lru_cache(maxsize=None)
+def compile_format(fmt: str) -> Callable[[Dict[str, Any]], str]:
+    """
+    Pre-parse a str.format() template with named fields.
+
+    Returns a function that renders the template for a mapping of field
+    values, like ``fmt.format(**params)``. The template is only tokenized
+    once; rendering looks up the fields and does a single %-format.
+
+    >>> compile_format('{a} ({b[x]:>3})')({'a': 'A', 'b': {'x': 1}})
+    'A (  1)'
+    """
+    formatter = Formatter()
+    template = []
+    fields = []  # type: List[Tuple[str, str, Optional[str]]]
+    for literal, field, spec, conversion in formatter.parse(fmt):
+        template.append(literal.replace('%', '%%'))
+        if field is not None:
+            # Placeholders are keyed by position, since the same field may
+            # be used several times with different conversions or specs
+            template.append('%({})s'.format(len(fields)))
+            fields.append((field, spec or '', conversion))
+    tmpl = ''.join(template)
+
+    def _render(params: Dict[str, Any]) -> str:
+        values = {}  # type: Dict[str, Any]
+        for i, (field, spec, conversion) in enumerate(fields):
+            value = formatter.get_field(field, (), params)[0]
+            if conversion is not None:
+                value = formatter.convert_field(value, conversion)
+            if spec:
+                if '{' in spec:
+                    spec = compile_format(spec)(params)  # Nested replacement fields
+                value = formatter.format_field(value, spec)
+            values[str(i)] = value
+        return tmpl % values
+
+    return _render
+
+
 # Initialize UUID cache
 uuid_cache_file = 'uuid_cache_chip.csv'
 uuid_cache = init_cache(uuid_cache_file)
+uuid_cache_initial_size = len(uuid_cache)  # Entries are only ever added
 
 
 def uuid(category: str, full_name: str, identifier: str, create: bool = True) -> str:
@@ -67,11 +274,19 @@ def uuid(category: str, full_name: str, identifier: str, create: bool = True) ->
             For example 'pad-1' or 'pin-13'.
     """
     key = '{}-{}-{}'.format(category, full_name, identifier).lower().replace(' ', '~')
-    if key not in uuid_cache:
+    return uuid_for_key(key, create)
+
+
+def uuid_for_key(key: str, create: bool = True) -> str:
+    """
+    Return the uuid for a normalized cache key (see uuid()).
+    """
+    value = uuid_cache.get(key)
+    if value is None:
         if not create:
             raise ValueError('Unknown UUID: {}'.format(key))
-        uuid_cache[key] = str(uuid4())
-    return uuid_cache[key]
+        value = uuid_cache[key] = random_uuid()
+    return value
 
 
 class BodyDimensions:
@@ -138,6 +353,7 @@ class ChipConfig:
         self.footprints = footprints
         self.gap = gap
         self.meta = meta
+        self._size_metric = None  # type: Optional[str]
         if self.footprints and self.gap:
             raise ValueError('Only set either footprints or gap, but not both')
         if not self.footprints and not self.gap:
@@ -147,10 +363,13 @@ class ChipConfig:
                 if density_level not in ['A', 'B', 'C']:
                     raise ValueError('Invalid density level: {}'.format(density_level))
 
+    @property
     def size_metric(self) -> str:
-        return str(int(self.body.length * 10)).rjust(2, '0') + \
-            str(int(self.body.width * 10)).rjust(2, '0')
+        if self._size_metric is None:
+            self._size_metric = '%02d%02d' % (int(self.body.length * 10), int(self.body.width * 10))
+        return self._size_metric
 
+    @property
     def size_imperial(self) -> str:
         return self._size_imperial
 
@@ -170,324 +389,342 @@ class PolarizationConfig:
         self.id_unmarked = id_unmarked
 
 
-def generate_pkg(
-    dirpath: str,
+def render_pkg(
     author: str,
     name: str,
     description: str,
     polarization: Optional[PolarizationConfig],
-    configs: Iterable[ChipConfig],
+    config: ChipConfig,
     pkgcat: str,
     keywords: str,
     version: str,
-    create_date: Optional[str]
-) -> None:
-    category = 'pkg'
-    for config in configs:
-        lines = []
+    create_date: Optional[str],
+    footprint_cache: Optional[Dict[Tuple[Any, ...], str]] = None
+) -> Tuple[str, str, str]:
+    """
+    Render the package for a single config.
 
-        fmt_params = {
-            'size_metric': config.size_metric(),
-            'size_imperial': config.size_imperial(),
-        }  # type: Dict[str, Any]
-        fmt_params_name = {
-            **fmt_params,
-            'length': fd(config.body.length),
-            'width': fd(config.body.width),
-            'height': fd(config.body.height),
-            'lead_length': fd(config.body.lead_length) if config.body.lead_length else None,
-            'lead_width': fd(config.body.lead_width) if config.body.lead_width else None,
-        }
-        fmt_params_desc = {
-            **fmt_params,
-            'length': config.body.length,
-            'width': config.body.width,
-            'height': config.body.height,
-            'meta': config.meta,
-        }
-        full_name = name.format(**fmt_params_name)
-        full_desc = description.format(**fmt_params_desc)
-        full_keywords = keywords.format(**fmt_params_desc).lower()
+    Returns the package UUID, the package name and the content of the
+    package file. Nothing is written to disk, see generate_pkg() for that.
 
-        def _uuid(identifier: str) -> str:
-            return uuid(category, full_name, identifier)
-
-        # UUIDs
-        uuid_pkg = _uuid('pkg')
-        if polarization:
-            uuid_pads = [
-                _uuid('pad-{}'.format(polarization.id_marked)),
-                _uuid('pad-{}'.format(polarization.id_unmarked)),
-            ]
+    Rendered footprints are stored in footprint_cache, pass the same dict
+    for all configs of a package family to reuse them.
+    """
+    category = 'pkg'
+    cache = {} if footprint_cache is None else footprint_cache  # type: Dict[Tuple[Any, ...], str]
+    out = io.StringIO()
+    w = out.write
+
+    fmt_params = {
+        'size_metric': config.size_metric,
+        'size_imperial': config.size_imperial,
+    }  # type: Dict[str, Any]
+    fmt_params_name = {
+        **fmt_params,
+        'length': fd(config.body.length),
+        'width': fd(config.body.width),
+        'height': fd(config.body.height),
+        'lead_length': fd(config.body.lead_length) if config.body.lead_length else None,
+        'lead_width': fd(config.body.lead_width) if config.body.lead_width else None,
+    }
+    fmt_params_desc = {
+        **fmt_params,
+        'length': config.body.length,
+        'width': config.body.width,
+        'height': config.body.height,
+        'meta': config.meta,
+    }
+    full_name = compile_format(name)(fmt_params_name)
+    full_desc = compile_format(description)(fmt_params_desc)
+    full_keywords = compile_format(keywords)(fmt_params_desc).lower()
+
+    # Normalized cache key prefix, so that only the short identifier
+    # needs to be normalized for every UUID of this package
+    uuid_prefix = '{}-{}-'.format(category, full_name).lower().replace(' ', '~')
+
+    def _uuid(identifier: str) -> str:
+        return uuid_for_key(uuid_prefix + identifier.lower().replace(' ', '~'))
+
+    # UUIDs, pad 1 is the left (marked) pad, pad 2 the right (unmarked) pad
+    uuid_pkg = _uuid('pkg')
+    if polarization:
+        uuid_pad_1 = _uuid('pad-{}'.format(polarization.id_marked))
+        uuid_pad_2 = _uuid('pad-{}'.format(polarization.id_unmarked))
+        name_pad_1 = polarization.name_marked
+        name_pad_2 = polarization.name_unmarked
+    else:
+        uuid_pad_1 = _uuid('pad-1')
+        uuid_pad_2 = _uuid('pad-2')
+        name_pad_1 = '1'
+        name_pad_2 = '2'
+
+    # General info
+    w(PKG_HEADER_TMPL % {
+        'uuid': uuid_pkg,
+        'name': full_name,
+        'description': full_desc,
+        'keywords': ','.join(filter(None, [
+            config.size_metric, config.size_imperial, full_keywords,
+        ])),
+        'author': author,
+        'version': version,
+        'created': create_date or now(),
+        'category': pkgcat,
+        'uuid_pad_1': uuid_pad_1,
+        'name_pad_1': name_pad_1,
+        'uuid_pad_2': uuid_pad_2,
+        'name_pad_2': name_pad_2,
+    })
+
+    # Line width and label offset adjusted for size of element
+    _, silk_lw, doc_lw = LINE_WIDTHS[bisect_right(LINE_WIDTHS_KEYS, config.body.length) - 1]
+    _, offset = LABEL_OFFSETS[bisect_right(LABEL_OFFSETS_KEYS, config.body.width) - 1]
+
+    # Formatted geometry that does not depend on the footprint variant,
+    # computed once per config and shared by all variants
+    geom = {
+        'hl': ff(config.body.length / 2),  # Half body length
+        'hw': ff(config.body.width / 2),  # Half body width
+        'doc_hl': ff(config.body.length / 2 - doc_lw / 2),
+        'doc_hw': ff(config.body.width / 2 - doc_lw / 2),
+        'mark_hw': ff(config.body.width / 2 - doc_lw),
+        'silk_hw': ff(config.body.width / 2 + silk_lw / 2),
+        'label_dy': ff(config.body.width / 2 + offset),
+    }
+    if config.body.gap:
+        geom['half_gap'] = ff(config.body.gap / 2)
+    if config.gap:
+        geom['silk_dx'] = ff(config.gap / 2 - silk_lw / 2 - silkscreen_clearance)
+
+    def render_footprint_variant(
+        density_level: str,
+        *,
+        gap: Optional[float] = None,
+        footprint: Optional[FootprintDimensions] = None
+    ) -> str:
+        """
+        Render a footprint variant as a %-template with the element UUIDs as
+        mapping keys (FOOTPRINT_UUIDS, 'pad-1' and 'pad-2').
+        """
+        uuids = FOOTPRINT_UUID_PLACEHOLDERS
+        variant_out = io.StringIO()
+        w = variant_out.write
+
+        # Max boundary
+        max_x = 0.0
+        max_y = 0.0
+
+        w(FOOTPRINT_HEADER_TMPL % {'uuid': uuids['footprint'], 'name': FOOTPRINT_VARIANTS[density_level][1]})
+
+        # Pads
+        if footprint is not None:
+            pad_width = footprint.pad_width
+            pad_length = footprint.pad_length
+            pad_gap = footprint.pad_gap
+            pad_dx = (pad_gap / 2 + pad_length / 2)  # x offset (delta-x)
+        elif gap is not None:
+            pad_gap = gap
+            pad_width = config.body.width + get_by_density(config.body.length, density_level, 'side')
+            pad_toe = get_by_density(config.body.length, density_level, 'toe')
+            pad_length = (config.body.length - gap) / 2 + pad_toe
+            pad_dx = (gap / 2 + pad_length / 2)  # x offset (delta-x)
         else:
-            uuid_pads = [_uuid('pad-1'), _uuid('pad-2')]
-
-        print('Generating pkg "{}": {}'.format(full_name, uuid_pkg))
-
-        # General info
-        lines.append('(librepcb_package {}'.format(uuid_pkg))
-        lines.append(' (name "{}")'.format(full_name))
-        lines.append(' (description "{}\\n\\nGenerated with {}")'.format(full_desc, generator))
-        lines.append(' (keywords "{}")'.format(','.join(filter(None, [
-            config.size_metric(), config.size_imperial(), full_keywords,
-        ]))))
-        lines.append(' (author "{}")'.format(author))
-        lines.append(' (version "{}")'.format(version))
-        lines.append(' (created {})'.format(create_date or now()))
-        lines.append(' (deprecated false)')
-        lines.append(' (category {})'.format(pkgcat))
-        if polarization:
-            lines.append(' (pad {} (name "{}"))'.format(uuid_pads[0], polarization.name_marked))
-            lines.append(' (pad {} (name "{}"))'.format(uuid_pads[1], polarization.name_unmarked))
+            raise ValueError('Either footprint or gap must be set')
+        pad_size = {'length': ff(pad_length), 'width': ff(pad_width)}
+        dx = ff(pad_dx)
+        w(PAD_TMPL % {**pad_size, 'uuid': uuids['pad-2'], 'x': dx})
+        w(PAD_TMPL % {**pad_size, 'uuid': uuids['pad-1'], 'x': '-' + dx})
+        max_x = max(max_x, pad_length / 2 + pad_dx, pad_length / 2 - pad_dx)
+        max_y = max(max_y, config.body.width / 2)
+        max_y = max(max_y, pad_width / 2)
+
+        # Documentation
+        half_gap_raw = (config.body.gap or pad_gap) / 2
+        half_gap = geom.get('half_gap') or ff(half_gap_raw)
+        if footprint is None:
+            # We assume that leads are across the entire width of the part (e.g. MLCC)
+            dx = geom['hl']
+            dy = geom['hw']
+            lead = {
+                'layer': 'top_documentation', 'width': 0.0, 'fill': 'true', 'grab_area': 'false', 'y': dy,
+            }  # type: Dict[str, Any]
+            w(RECT_POLYGON_TMPL % {
+                **lead, 'uuid': uuids['polygon-outline-left'], 'x1': '-' + dx, 'x2': '-' + half_gap,
+            })
+            w(RECT_POLYGON_TMPL % {
+                **lead, 'uuid': uuids['polygon-outline-right'], 'x1': dx, 'x2': half_gap,
+            })
+            dy = geom['doc_hw']
+            outline = {
+                'layer': 'top_documentation', 'width': doc_lw, 'x1': '-' + half_gap, 'x2': half_gap,
+            }  # type: Dict[str, Any]
+            w(LINE_POLYGON_TMPL % {**outline, 'uuid': uuids['polygon-outline-top'], 'y': dy})
+            w(LINE_POLYGON_TMPL % {**outline, 'uuid': uuids['polygon-outline-bot'], 'y': '-' + dy})
         else:
-            lines.append(' (pad {} (name "1"))'.format(uuid_pads[0]))
-            lines.append(' (pad {} (name "2"))'.format(uuid_pads[1]))
-
-        def add_footprint_variant(
-            key: str,
-            name: str,
-            density_level: str,
-            *,
-            gap: Optional[float] = None,
-            footprint: Optional[FootprintDimensions] = None
-        ) -> None:
-            """
-            Generate a footprint variant.
-
-            Note: Either the toe extension or footprint dimensions must be set.
-            """
-            if gap is not None and footprint is not None:
-                raise ValueError('Only toe extension or footprint may be set')
-            if gap is None and footprint is None:
-                raise ValueError('Either toe extension or footprint must be set')
-            uuid_footprint = _uuid('footprint-{}'.format(key))
-            uuid_text_name = _uuid('text-name-{}'.format(key))
-            uuid_text_value = _uuid('text-value-{}'.format(key))
-            uuid_silkscreen_top = _uuid('line-silkscreen-top-{}'.format(key))
-            uuid_silkscreen_bot = _uuid('line-silkscreen-bot-{}'.format(key))
-            uuid_courtyard = _uuid('polygon-courtyard-{}'.format(key))
-            uuid_outline_top = _uuid('polygon-outline-top-{}'.format(key))
-            uuid_outline_bot = _uuid('polygon-outline-bot-{}'.format(key))
-            uuid_outline_left = _uuid('polygon-outline-left-{}'.format(key))
-            uuid_outline_right = _uuid('polygon-outline-right-{}'.format(key))
-            uuid_outline_around = _uuid('polygon-outline-around-{}'.format(key))
-            uuid_polarization_mark = _uuid('polygon-polarization-mark-{}'.format(key))
-
-            # Max boundary
-            max_x = 0.0
-            max_y = 0.0
-
-            # Line width adjusted for size of element
-            if config.body.length >= 2.0:
-                silk_lw = line_width
-                doc_lw = line_width
-            elif config.body.length >= 1.0:
-                silk_lw = line_width_thin
-                doc_lw = line_width_thin
-            else:
-                silk_lw = line_width_thin
-                doc_lw = line_width_thinner
-
-            lines.append(' (footprint {}'.format(uuid_footprint))
-            lines.append('  (name "{}")'.format(name))
-            lines.append('  (description "")')
-
-            # Pads
-            if footprint is not None:
-                pad_width = footprint.pad_width
-                pad_length = footprint.pad_length
-                pad_gap = footprint.pad_gap
-                pad_dx = (pad_gap / 2 + pad_length / 2)  # x offset (delta-x)
-            elif gap is not None:
-                pad_gap = gap
-                pad_width = config.body.width + get_by_density(config.body.length, density_level, 'side')
-                pad_toe = get_by_density(config.body.length, density_level, 'toe')
-                pad_length = (config.body.length - gap) / 2 + pad_toe
-                pad_dx = (gap / 2 + pad_length / 2)  # x offset (delta-x)
-            else:
-                raise ValueError('Either footprint or gap must be set')
-            for p in [0, 1]:
-                pad_uuid = uuid_pads[p - 1]
-                sign = -1 if p == 1 else 1
-                lines.append('  (pad {} (side top) (shape rect)'.format(pad_uuid))
-                lines.append('   (position {} 0.0) (rotation 0.0) (size {} {}) (drill 0.0)'.format(
-                    ff(sign * pad_dx),
-                    ff(pad_length),
-                    ff(pad_width),
-                ))
-                max_x = max(max_x, pad_length / 2 + sign * pad_dx)
-                lines.append('  )')
-            max_y = max(max_y, config.body.width / 2)
-            max_y = max(max_y, pad_width / 2)
-
-            # Documentation
-            half_gap_raw = (config.body.gap or pad_gap) / 2
-            half_gap = ff(half_gap_raw)
-            if footprint is None:
-                # We assume that leads are across the entire width of the part (e.g. MLCC)
-                dx = ff(config.body.length / 2)
-                dy = ff(config.body.width / 2)
-                lines.append('  (polygon {} (layer {})'.format(uuid_outline_left, 'top_documentation'))
-                lines.append('   (width 0.0) (fill true) (grab_area false)')
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx, dy))  # NW
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(half_gap, dy))  # NE
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(half_gap, dy))  # SE
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(dx, dy))  # SW
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx, dy))  # NW
-                lines.append('  )')
-                lines.append('  (polygon {} (layer {})'.format(uuid_outline_right, 'top_documentation'))
-                lines.append('   (width 0.0) (fill true) (grab_area false)')
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(dx, dy))  # NE
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(half_gap, dy))  # NW
-                lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(half_gap, dy))  # SW
-                lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(dx, dy))  # SE
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(dx, dy))  # NE
-                lines.append('  )')
-                dy = ff(config.body.width / 2 - doc_lw / 2)
-                lines.append('  (polygon {} (layer {})'.format(uuid_outline_top, 'top_documentation'))
-                lines.append('   (width {}) (fill false) (grab_area false)'.format(doc_lw))
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('  )')
-                lines.append('  (polygon {} (layer {})'.format(uuid_outline_bot, 'top_documentation'))
-                lines.append('   (width {}) (fill false) (grab_area false)'.format(doc_lw))
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('  )')
-            else:
-                # We have more precise information about the lead (e.g. molded
-                # packages where leads are not the full width of the package).
-                dx = ff(config.body.length / 2 - doc_lw / 2)
-                dy = ff(config.body.width / 2 - doc_lw / 2)
-                lines.append('  (polygon {} (layer {})'.format(uuid_outline_around, 'top_documentation'))
-                lines.append('   (width {}) (fill false) (grab_area false)'.format(doc_lw))
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx, dy))
-                lines.append('  )')
-                dx = ff(config.body.length / 2)
-                dy = ff((config.body.lead_width or footprint.pad_width) / 2)
-                lines.append('  (polygon {} (layer {})'.format(uuid_outline_left, 'top_documentation'))
-                lines.append('   (width 0.0) (fill true) (grab_area false)')
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx, dy))
-                lines.append('  )')
-                lines.append('  (polygon {} (layer {})'.format(uuid_outline_right, 'top_documentation'))
-                lines.append('   (width 0.0) (fill true) (grab_area false)')
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(half_gap, dy))
-                lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(dx, dy))
-                lines.append('   (vertex (position {} {}) (angle 0.0))'.format(dx, dy))
-                lines.append('  )')
+            # We have more precise information about the lead (e.g. molded
+            # packages where leads are not the full width of the package).
+            dx = geom['doc_hl']
+            dy = geom['doc_hw']
+            w(RECT_POLYGON_TMPL % {
+                'uuid': uuids['polygon-outline-around'], 'layer': 'top_documentation', 'width': doc_lw,
+                'fill': 'false', 'grab_area': 'false', 'x1': '-' + dx, 'x2': dx, 'y': dy,
+            })
+            dx = geom['hl']
+            dy = ff((config.body.lead_width or footprint.pad_width) / 2)
+            lead = {
+                'layer': 'top_documentation', 'width': 0.0, 'fill': 'true', 'grab_area': 'false', 'y': dy,
+            }
+            w(RECT_POLYGON_TMPL % {
+                **lead, 'uuid': uuids['polygon-outline-left'], 'x1': '-' + dx, 'x2': '-' + half_gap,
+            })
+            w(RECT_POLYGON_TMPL % {
+                **lead, 'uuid': uuids['polygon-outline-right'], 'x1': dx, 'x2': half_gap,
+            })
+        if polarization:
+            polarization_mark_width = config.body.width / 8
+            w(RECT_POLYGON_TMPL % {
+                'uuid': uuids['polygon-polarization-mark'], 'layer': 'top_documentation', 'width': 0.0,
+                'fill': 'true', 'grab_area': 'true',
+                'x1': '-' + ff(half_gap_raw - polarization_mark_width / 2),
+                'x2': '-' + ff(half_gap_raw - polarization_mark_width * 1.5),
+                'y': geom['mark_hw'],
+            })
+
+        # Silkscreen
+        if config.body.length > 1.0:
             if polarization:
-                polarization_mark_width = config.body.width / 8
-                dx_outer = ff(half_gap_raw - polarization_mark_width / 2)
-                dx_inner = ff(half_gap_raw - polarization_mark_width * 1.5)
-                dy = ff(config.body.width / 2 - doc_lw)
-                lines.append('  (polygon {} (layer {})'.format(uuid_polarization_mark, 'top_documentation'))
-                lines.append('   (width 0.0) (fill true) (grab_area true)')
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx_outer, dy))
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx_inner, dy))
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(dx_inner, dy))
-                lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(dx_outer, dy))
-                lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx_outer, dy))
-                lines.append('  )')
-
-            # Silkscreen
-            if config.body.length > 1.0:
-                if polarization:
-                    dx_unmarked = pad_dx + pad_length / 2
-                    dx_marked = dx_unmarked + silk_lw / 2 + silkscreen_clearance
-                    dy = ff(max(
-                        config.body.width / 2 + silk_lw / 2,  # Based on body width
-                        pad_width / 2 + silk_lw / 2 + silkscreen_clearance,  # Based on pad width
-                    ))
-                    lines.append('  (polygon {} (layer {})'.format(uuid_silkscreen_top, 'top_placement'))
-                    lines.append('   (width {}) (fill false) (grab_area false)'.format(silk_lw))
-                    lines.append('   (vertex (position {} {}) (angle 0.0))'.format(ff(dx_unmarked), dy))
-                    lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(ff(dx_marked), dy))
-                    lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(ff(dx_marked), dy))
-                    lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(ff(dx_unmarked), dy))
-                    lines.append('  )')
-                else:
-                    assert gap is not None, \
-                        "Support for non-polarized packages with irregular pads not yet fully implemented"
-                    dx = ff(gap / 2 - silk_lw / 2 - silkscreen_clearance)
-                    dy = ff(config.body.width / 2 + silk_lw / 2)
-                    lines.append('  (polygon {} (layer {})'.format(uuid_silkscreen_top, 'top_placement'))
-                    lines.append('   (width {}) (fill false) (grab_area false)'.format(silk_lw))
-                    lines.append('   (vertex (position -{} {}) (angle 0.0))'.format(dx, dy))
-                    lines.append('   (vertex (position {} {}) (angle 0.0))'.format(dx, dy))
-                    lines.append('  )')
-                    lines.append('  (polygon {} (layer {})'.format(uuid_silkscreen_bot, 'top_placement'))
-                    lines.append('   (width {}) (fill false) (grab_area false)'.format(silk_lw))
-                    lines.append('   (vertex (position -{} -{}) (angle 0.0))'.format(dx, dy))
-                    lines.append('   (vertex (position {} -{}) (angle 0.0))'.format(dx, dy))
-                    lines.append('  )')
-
-            # Courtyard
-            courtyard_excess = get_by_density(config.body.length, density_level, 'courtyard')
-            lines.extend(indent(2, generate_courtyard(
-                uuid=uuid_courtyard,
-                max_x=max_x,
-                max_y=max_y,
-                excess_x=courtyard_excess,
-                excess_y=courtyard_excess,
-            )))
-
-            # Labels
-            if config.body.width < 2.0:
-                offset = label_offset_thin
+                dx_unmarked = pad_dx + pad_length / 2
+                dx_marked = dx_unmarked + silk_lw / 2 + silkscreen_clearance
+                dy = ff(max(
+                    config.body.width / 2 + silk_lw / 2,  # Based on body width
+                    pad_width / 2 + silk_lw / 2 + silkscreen_clearance,  # Based on pad width
+                ))
+                w(OPEN_RECT_POLYGON_TMPL % {
+                    'uuid': uuids['line-silkscreen-top'], 'layer': 'top_placement', 'width': silk_lw,
+                    'x1': ff(dx_unmarked), 'x2': '-' + ff(dx_marked), 'y': dy,
+                })
             else:
-                offset = label_offset
-            dy = ff(config.body.width / 2 + offset)  # y offset (delta-y)
-            text_attrs = '(height {}) (stroke_width 0.2) ' \
-                         '(letter_spacing auto) (line_spacing auto)'.format(pkg_text_height)
-            lines.append('  (stroke_text {} (layer top_names)'.format(uuid_text_name))
-            lines.append('   {}'.format(text_attrs))
-            lines.append('   (align center bottom) (position 0.0 {}) (rotation 0.0)'.format(dy))
-            lines.append('   (auto_rotate true) (mirror false) (value "{{NAME}}")')
-            lines.append('  )')
-            lines.append('  (stroke_text {} (layer top_values)'.format(uuid_text_value))
-            lines.append('   {}'.format(text_attrs))
-            lines.append('   (align center top) (position 0.0 -{}) (rotation 0.0)'.format(dy))
-            lines.append('   (auto_rotate true) (mirror false) (value "{{VALUE}}")')
-            lines.append('  )')
-
-            lines.append(' )')
-
-        if config.gap:
-            add_footprint_variant('density~b', 'Density Level B (median protrusion)', 'B', gap=config.gap)
-            add_footprint_variant('density~a', 'Density Level A (max protrusion)', 'A', gap=config.gap)
-        elif config.footprints:
-            a = config.footprints.get('A')
-            b = config.footprints.get('B')
-            c = config.footprints.get('C')
-            if b:
-                add_footprint_variant('density~b', 'Density Level B (median protrusion)', 'B', footprint=b)
-            if a:
-                add_footprint_variant('density~a', 'Density Level A (max protrusion)', 'A', footprint=a)
-            if c:
-                add_footprint_variant('density~c', 'Density Level C (min protrusion)', 'C', footprint=c)
-        else:
-            raise ValueError('Either gap or footprints must be set')
+                assert gap is not None, \
+                    "Support for non-polarized packages with irregular pads not yet fully implemented"
+                dx = geom['silk_dx']
+                dy = geom['silk_hw']
+                silkscreen = {
+                    'layer': 'top_placement', 'width': silk_lw, 'x1': '-' + dx, 'x2': dx,
+                }  # type: Dict[str, Any]
+                w(LINE_POLYGON_TMPL % {**silkscreen, 'uuid': uuids['line-silkscreen-top'], 'y': dy})
+                w(LINE_POLYGON_TMPL % {**silkscreen, 'uuid': uuids['line-silkscreen-bot'], 'y': '-' + dy})
+
+        # Courtyard
+        courtyard_excess = get_by_density(config.body.length, density_level, 'courtyard')
+        for line in indent(2, generate_courtyard(
+            uuid=uuids['polygon-courtyard'],
+            max_x=max_x,
+            max_y=max_y,
+            excess_x=courtyard_excess,
+            excess_y=courtyard_excess,
+        )):
+            w(line)
+            w('\n')
+
+        # Labels
+        w(LABELS_TMPL % {
+            'uuid_name': uuids['text-name'],
+            'uuid_value': uuids['text-value'],
+            'dy': geom['label_dy'],  # y offset (delta-y)
+        })
+
+        w(' )\n')
+        return variant_out.getvalue()
+
+    def add_footprint_variant(
+        density_level: str,
+        *,
+        gap: Optional[float] = None,
+        footprint: Optional[FootprintDimensions] = None
+    ) -> None:
+        """
+        Generate a footprint variant.
+
+        Note: Either the toe extension or footprint dimensions must be set.
+        """
+        if gap is not None and footprint is not None:
+            raise ValueError('Only toe extension or footprint may be set')
+        if gap is None and footprint is None:
+            raise ValueError('Either toe extension or footprint must be set')
+        key = FOOTPRINT_VARIANTS[density_level][0]
+        uuids = {identifier: _uuid('{}-{}'.format(identifier, key)) for identifier in FOOTPRINT_UUIDS}
+        uuids['pad-1'] = uuid_pad_1
+        uuids['pad-2'] = uuid_pad_2
+
+        # The footprint does not depend on the body height, so configs that
+        # only differ in height share the rendered template
+        cache_key = (
+            density_level,
+            polarization is not None,
+            config.body.length,
+            config.body.width,
+            config.body.lead_length,
+            config.body.lead_width,
+            gap,
+            (footprint.pad_length, footprint.pad_width, footprint.pad_gap) if footprint else None,
+        )
+        template = cache.get(cache_key)
+        if template is None:
+            template = cache[cache_key] = render_footprint_variant(
+                density_level, gap=gap, footprint=footprint,
+            )
+        w(template % uuids)
+
+    if config.gap:
+        for density_level in ['B', 'A']:
+            add_footprint_variant(density_level, gap=config.gap)
+    elif config.footprints:
+        for density_level in FOOTPRINT_VARIANTS:
+            footprint = config.footprints.get(density_level)
+            if footprint:
+                add_footprint_variant(density_level, footprint=footprint)
+    else:
+        raise ValueError('Either gap or footprints must be set')
+
+    w(')\n')
+
+    return uuid_pkg, full_name, out.getvalue()
 
-        lines.append(')')
+
+def generate_pkg(
+    dirpath: str,
+    author: str,
+    name: str,
+    description: str,
+    polarization: Optional[PolarizationConfig],
+    configs: Iterable[ChipConfig],
+    pkgcat: str,
+    keywords: str,
+    version: str,
+    create_date: Optional[str]
+) -> None:
+    footprint_cache = {}  # type: Dict[Tuple[Any, ...], str]
+    log_lines = []  # type: List[str]
+    for config in configs:
+        uuid_pkg, full_name, content = render_pkg(
+            author=author,
+            name=name,
+            description=description,
+            polarization=polarization,
+            config=config,
+            pkgcat=pkgcat,
+            keywords=keywords,
+            version=version,
+            create_date=create_date,
+            footprint_cache=footprint_cache,
+        )
+        log_lines.append('Generating pkg "{}": {}\n'.format(full_name, uuid_pkg))
 
         pkg_dir_path = path.join(dirpath, uuid_pkg)
-        if not (path.exists(pkg_dir_path) and path.isdir(pkg_dir_path)):
-            makedirs(pkg_dir_path)
-        with open(path.join(pkg_dir_path, '.librepcb-pkg'), 'w') as f:
-            f.write('0.1\n')
-        with open(path.join(pkg_dir_path, 'package.lp'), 'w') as f:
-            f.write('\n'.join(lines))
-            f.write('\n')
+        makedirs(pkg_dir_path, exist_ok=True)
+        write_file(path.join(pkg_dir_path, '.librepcb-pkg'), '0.1\n')
+        write_file(path.join(pkg_dir_path, 'package.lp'), content)
+    sys.stdout.write(''.join(log_lines))
 
 
 def generate_dev(
@@ -539,15 +776,12 @@ def generate_dev(
         for (pad, signal) in sorted(zip(pads, signals)):
             lines.append(' (pad {} (signal {}))'.format(pad, signal))
         lines.append(')')
+        lines.append('')  # Trailing newline
 
         dev_dir_path = path.join(dirpath, uuid_dev)
-        if not (path.exists(dev_dir_path) and path.isdir(dev_dir_path)):
-            makedirs(dev_dir_path)
-        with open(path.join(dev_dir_path, '.librepcb-dev'), 'w') as f:
-            f.write('0.1\n')
-        with open(path.join(dev_dir_path, 'device.lp'), 'w') as f:
-            f.write('\n'.join(lines))
-            f.write('\n')
+        makedirs(dev_dir_path, exist_ok=True)
+        write_file(path.join(dev_dir_path, '.librepcb-dev'), '0.1\n')
+        write_file(path.join(dev_dir_path, 'device.lp'), '\n'.join(lines))
 
 
 if __name__ == '__main__':
@@ -710,4 +944,7 @@ if __name__ == '__main__':
         version='0.3',
         create_date='2019-01-29T19:47:42Z',
     )
-    save_cache(uuid_cache_file, uuid_cache)
+    if len(uuid_cache) != uuid_cache_initial_size:
+        save_cache(uuid_cache_file, uuid_cache)
+    else:
+        print('Cache unchanged: {}'.format(uuid_cache_file))
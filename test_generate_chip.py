@@ -0,0 +1,89 @@
+from uuid import UUID
+
+import pytest
+
+import generate_chip
+
+
+def test_random_uuid():
+    value = generate_chip.random_uuid()
+    parsed = UUID(value)
+    assert parsed.version == 4
+    assert str(parsed) == value
+    assert generate_chip.random_uuid() != value
+
+
+@pytest.mark.parametrize(['body', 'size_metric'], [
+    (generate_chip.BodyDimensions(.4, .2, 0.15), '0402'),
+    (generate_chip.BodyDimensions(3.2, 1.6, 0.70), '3216'),
+    (generate_chip.BodyDimensions(11.56, 6.98, 5.84), '11569'),
+])
+def test_size_metric(body, size_metric):
+    config = generate_chip.ChipConfig('', body, gap=0.2)
+    assert config.size_metric == size_metric
+
+
+@pytest.mark.parametrize('fmt', [
+    'RESC{size_metric} ({size_imperial})',
+    'CAPPM{length}X{width}X{height}L{lead_length}X{lead_width}',
+    'Generic capacitor (EIA {meta[eia]}).\\n\\nLength: {length}mm, 100%',
+    '{{literal}} {length!r} {width:.2f}',
+    '{size_metric!r} {size_metric}',
+    '{length:>6}|{length}',
+    '{length:{spec}}|{width:>{spec_width}}',
+])
+def test_compile_format(fmt):
+    params = {
+        'size_metric': '3216',
+        'size_imperial': '1206',
+        'length': 3.2,
+        'width': 1.6,
+        'height': '120',
+        'lead_length': '80',
+        'lead_width': None,
+        'meta': {'eia': '3216-12'},
+        'spec': '>8',
+        'spec_width': 5,
+    }
+    assert generate_chip.compile_format(fmt)(params) == fmt.format(**params)
+
+
+def test_write_file_skips_unchanged(tmp_path):
+    filepath = str(tmp_path / 'package.lp')
+    assert generate_chip.write_file(filepath, '(librepcb_package)\n') is True
+    assert generate_chip.write_file(filepath, '(librepcb_package)\n') is False
+    assert generate_chip.write_file(filepath, '(librepcb_package )\n') is True
+    with open(filepath, 'r') as f:
+        assert f.read() == '(librepcb_package )\n'
+
+
+def test_render_pkg_shares_footprints_across_heights():
+    def _render(config, footprint_cache):
+        return generate_chip.render_pkg(
+            author='Test',
+            name='CAPPM{length}X{width}X{height}L{lead_length}X{lead_width}',
+            description='Test',
+            polarization=generate_chip.PolarizationConfig(
+                name_marked='+',
+                id_marked='p',
+                name_unmarked='-',
+                id_unmarked='n',
+            ),
+            config=config,
+            pkgcat='a20f0330-06d3-4bc2-a1fa-f8577deb6770',
+            keywords='test',
+            version='0.1',
+            create_date='2019-11-18T21:56:00Z',
+            footprint_cache=footprint_cache,
+        )[2]
+
+    footprint_cache = {}
+    for height in [1.0, 1.2]:
+        config = generate_chip.ChipConfig('', generate_chip.BodyDimensions(3.2, 1.6, height, 0.8, 1.2), footprints={
+            'A': generate_chip.FootprintDimensions(2.20, 1.35, 0.62),
+            'B': generate_chip.FootprintDimensions(1.80, 1.23, 0.82),
+        })
+        shared = _render(config, footprint_cache)
+        assert '%' not in shared
+        assert shared == _render(config, {})
+    assert len(footprint_cache) == 2